@@ -1,21 +1,44 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.pool import PoolMeta
+from decimal import Decimal, ROUND_HALF_EVEN
+from trytond.model import ModelView
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 from trytond.modules.stock_number_of_packages.package import PackagedMixin
 
-__all__ = ['SaleLine']
+__all__ = ['Sale', 'SaleLine']
+
+
+class Sale(metaclass=PoolMeta):
+    __name__ = 'sale.sale'
+
+    @classmethod
+    @ModelView.button
+    def process(cls, sales):
+        SaleLine = Pool().get('sale.line')
+        # Read the packages of all the moves to invoice at once instead of
+        # once per sale line in SaleLine.get_invoice_line
+        move_ids = [m.id for s in sales for l in s.lines for m in l.moves]
+        with Transaction().set_context(
+                moves_number_of_packages=(
+                    SaleLine._get_moves_number_of_packages(move_ids))):
+            super(Sale, cls).process(sales)
 
 
 class SaleLine(PackagedMixin, metaclass=PoolMeta):
     __name__ = 'sale.line'
 
     def get_invoice_line(self):
+        Package = Pool().get('product.pack')
         invoice_lines = super(SaleLine, self).get_invoice_line()
         if not invoice_lines:
             return invoice_lines
         if not self.package:
             return invoice_lines
 
+        moves_number_of_packages = Transaction().context.get(
+            'moves_number_of_packages') or {}
         for invoice_line in invoice_lines:
             if invoice_line.type != 'line':
                 continue
@@ -28,22 +51,67 @@ class SaleLine(PackagedMixin, metaclass=PoolMeta):
                     continue
                 invoice_line.package = self.package
                 if invoice_line.quantity != abs(self.quantity):
-                    number_of_packages = int(round(invoice_line.quantity /
-                            self.package.qty))
+                    number_of_packages = (
+                        self.quantity_to_number_of_packages(
+                            invoice_line.quantity, self.unit))
                 else:
                     number_of_packages = abs(self.number_of_packages)
+                invoice_line.number_of_packages = number_of_packages
             else:
                 number_of_packages = 0
                 packages = set()
                 for move in invoice_line.stock_moves:
-                    if move.package:
-                        packages.add(move.package)
-                    number_of_packages += move.number_of_packages or 0
+                    if move.id in moves_number_of_packages:
+                        move_n_packages, package = (
+                            moves_number_of_packages[move.id])
+                    else:
+                        move_n_packages = move.number_of_packages
+                        package = move.package.id if move.package else None
+                    if package is not None:
+                        packages.add(package)
+                    number_of_packages += move_n_packages or 0
                 if len(packages) == 1:
-                    invoice_line.package = packages.pop()
+                    invoice_line.package = Package(packages.pop())
                 invoice_line.number_of_packages = number_of_packages
         return invoice_lines
 
+    @classmethod
+    def _get_moves_number_of_packages(cls, move_ids):
+        '''
+        Return a dictionary with move id as key and the tuple
+        (number of packages, package id) as value, using one query per slice
+        of moves.
+        '''
+        Move = Pool().get('stock.move')
+        cursor = Transaction().connection.cursor()
+        move = Move.__table__()
+
+        moves = {}
+        for sub_ids in grouped_slice(move_ids):
+            cursor.execute(*move.select(
+                    move.id, move.number_of_packages, move.package,
+                    where=reduce_ids(move.id, sub_ids)))
+            for move_id, number_of_packages, package in cursor.fetchall():
+                moves[move_id] = (number_of_packages, package)
+        return moves
+
+    def quantity_to_number_of_packages(self, quantity, uom):
+        '''
+        Return the number of packages of the line package needed for
+        quantity expressed in uom.
+        The division is done with decimals and rounded half to even, like
+        round(), but without float errors: 0.35 / 0.1 is 3.4999999999999996
+        with floats and would be rounded down.
+        '''
+        Uom = Pool().get('product.uom')
+        if self.package.uom and uom and self.package.uom != uom:
+            quantity = Uom.compute_qty(uom, quantity, self.package.uom,
+                round=False)
+        number_of_packages = (Decimal(str(quantity))
+            / Decimal(str(self.package.qty)))
+        return int(number_of_packages.quantize(Decimal(1),
+                rounding=ROUND_HALF_EVEN))
+
     def get_move(self, shipment_type):
         move = super(SaleLine, self).get_move(shipment_type)
         if not move:
@@ -52,10 +120,9 @@ class SaleLine(PackagedMixin, metaclass=PoolMeta):
             return
 
         move.package = self.package
-        # TODO: UoM?
         if move.quantity != abs(self.quantity):
-            move.number_of_packages = int(
-                round(move.quantity / self.package.qty))
+            move.number_of_packages = self.quantity_to_number_of_packages(
+                move.quantity, move.uom)
         else:
             move.number_of_packages = self.number_of_packages
         return move
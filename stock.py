@@ -1,10 +1,15 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import datetime
 import math
+import uuid
 from sql import Null
+from trytond import backend
 from trytond.model import Model, fields, Check
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
@@ -34,6 +39,83 @@ class Product(metaclass=PoolMeta):
             context['number_of_packages'] = True
         return context
 
+    @classmethod
+    def package_positions(cls, location_ids, product_ids=None, size=None):
+        """
+        Generate the stock of the locations and their children as tuples of
+        (location id, product id, lot id, package id, number of packages,
+        normalized number of packages).
+        Quantities are not propagated to parent locations. The products are
+        read in slices of size and, on PostgreSQL, the rows are fetched from
+        a server-side cursor so the memory used does not depend on the size
+        of the warehouse. On other backends a slice is fetched at once, so
+        size must be small enough for its rows to fit in memory.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        transaction = Transaction()
+
+        if product_ids is None:
+            product_ids = [p.id for p in cls.search([
+                        ('type', 'in', ['goods', 'assets']),
+                        ])]
+        context = {
+            'number_of_packages': True,
+            }
+        if transaction.context.get('stock_date_end') is None:
+            context['stock_date_end'] = Date.today()
+
+        for sub_product_ids in grouped_slice(product_ids, size):
+            with transaction.set_context(context):
+                query = Move.compute_quantities_query(location_ids,
+                    with_childs=True,
+                    grouping=('product', 'lot', 'package'),
+                    grouping_filter=(list(sub_product_ids),))
+            if query is None:
+                continue
+            if backend.name() == 'postgresql':
+                # Named cursors must be unique in the connection
+                cursor = transaction.connection.cursor(
+                    'package_positions_%s' % uuid.uuid4().hex)
+            else:
+                cursor = transaction.connection.cursor()
+            try:
+                cursor.execute(*query)
+                while True:
+                    rows = cursor.fetchmany(transaction.database.IN_MAX)
+                    if not rows:
+                        break
+                    id2lot = {l.id: l for l in Lot.browse(
+                            list({r[2] for r in rows if r[2]}))}
+                    for (location_id, product_id, lot_id, package_id,
+                            n_packages) in rows:
+                        n_packages = int(n_packages or 0)
+                        if not n_packages:
+                            continue
+                        normalized_n_packages = n_packages
+                        if lot_id:
+                            lot = id2lot[lot_id]
+                            normalized_n_packages = (
+                                lot.compute_normalized_number_of_packages(
+                                    n_packages))
+                        yield (location_id, product_id, lot_id, package_id,
+                            n_packages, normalized_n_packages)
+            finally:
+                cursor.close()
+
+    @classmethod
+    def export_package_positions(cls, file, location_ids, product_ids=None,
+            size=None):
+        "Write package_positions as CSV to file"
+        writer = csv.writer(file)
+        writer.writerow(['location', 'product', 'lot', 'package',
+                'number_of_packages', 'normalized_number_of_packages'])
+        for position in cls.package_positions(location_ids,
+                product_ids=product_ids, size=size):
+            writer.writerow(position)
+
 
 class Lot(metaclass=PoolMeta):
     __name__ = 'stock.lot'
@@ -167,11 +249,52 @@ class Move(metaclass=PoolMeta):
 
     @classmethod
     def assign_try(cls, moves, with_childs=True, grouping=('product',)):
-        if not Transaction().context.get('assign_number_of_packages'):
+        context = Transaction().context
+        if not context.get('assign_number_of_packages'):
             return super(Move, cls).assign_try(moves, with_childs=with_childs,
                 grouping=grouping)
         assert grouping in (('product',), ('product', 'lot')), \
             "Unexpected grouping"
+        package_lot_moves, package_moves, no_package_moves = (
+            cls.split_number_of_packages_moves(moves))
+        success = True
+        # Filled for assign_try_with_shortages
+        shortages = context.get('number_of_packages_shortages')
+
+        if package_lot_moves:
+            success &= cls.assign_try_number_of_packages(package_lot_moves,
+                with_childs, ('product', 'lot'), shortages=shortages)
+        if package_moves:
+            success &= cls.assign_try_number_of_packages(package_moves,
+                with_childs, ('product', 'package'), shortages=shortages)
+        if no_package_moves:
+            success &= super(Move, cls).assign_try(no_package_moves,
+                with_childs=with_childs, grouping=grouping)
+        return success
+
+    @classmethod
+    def assign_try_with_shortages(cls, moves, with_childs=True,
+            grouping=('product',)):
+        """
+        Try to assign moves by number of packages with assign_try.
+        Return a tuple with the success and the shortages of the moves with
+        package (see get_number_of_packages_shortages) to feed procurement
+        or back-order steps.
+        """
+        shortages = {}
+        with Transaction().set_context(
+                assign_number_of_packages=True,
+                number_of_packages_shortages=shortages):
+            success = cls.assign_try(moves, with_childs=with_childs,
+                grouping=grouping)
+        return success, shortages
+
+    @classmethod
+    def split_number_of_packages_moves(cls, moves):
+        """
+        Split moves into those assigned by (product, lot), those assigned by
+        (product, package) and those assigned by the standard assign_try.
+        """
         package_lot_moves = []
         package_moves = []
         no_package_moves = []
@@ -194,31 +317,106 @@ class Move(metaclass=PoolMeta):
                     package_moves.append(move)
             else:
                 no_package_moves.append(move)
+        return package_lot_moves, package_moves, no_package_moves
+
+    @classmethod
+    def assign_try_number_of_packages(cls, moves, with_childs, grouping,
+            shortages=None):
+        """
+        Assign moves by number of packages.
+        If shortages is a dictionary, the packages that could not be picked
+        are added to it.
+        """
+        Move = Pool().get('stock.move')
+
+        Transaction().database.lock(Transaction().connection, cls._table)
+
+        plan = cls.plan_number_of_packages(moves, with_childs, grouping)
+        if shortages is not None:
+            cls.get_number_of_packages_shortages(plan, shortages)
+
         success = True
+        to_write = []
+        to_assign = []
+        remainders = {}
+        for move_plan in plan:
+            move = move_plan['move']
+            not_picked_n_packages = move_plan['not_picked_n_packages']
+            if not_picked_n_packages:
+                success = False
+            first = not not_picked_n_packages
 
-        if package_lot_moves:
-            success &= cls.assign_try_number_of_packages(package_lot_moves,
-                with_childs, ('product', 'lot'))
-        if package_moves:
-            success &= cls.assign_try_number_of_packages(package_moves,
-                with_childs, ('product', 'package'))
-        if no_package_moves:
-            success &= super(Move, cls).assign_try(no_package_moves,
-                with_childs=with_childs, grouping=grouping)
+            for values in move_plan['picks']:
+                if first:
+                    to_write.extend(([move], values))
+                    to_assign.append(move)
+                    first = False
+                else:
+                    new_move, = cls.copy([move], default=values)
+                    to_assign.append(new_move)
+
+            if not_picked_n_packages:
+                remainders.setdefault((not_picked_n_packages,
+                        move_plan['not_picked_quantity']), []).append(move)
+
+        for (n_packages, quantity), remainder_moves in remainders.items():
+            to_write.extend((remainder_moves, {
+                        'number_of_packages': n_packages,
+                        'quantity': quantity,
+                        }))
+        if to_write:
+            Move.write(*to_write)
+        if to_assign:
+            Move.assign(to_assign)
         return success
 
     @classmethod
-    def assign_try_number_of_packages(cls, moves, with_childs, grouping):
+    def get_number_of_packages_shortages(cls, plan, shortages=None):
+        """
+        Summarise the packages that could not be picked in plan.
+        Return a dictionary with (product id, lot id, package id, location id)
+        as key and a dictionary with number_of_packages, quantity in the
+        default UoM of the product and moves as value.
+        If shortages is given, it is updated and returned.
+        """
+        Uom = Pool().get('product.uom')
+
+        if shortages is None:
+            shortages = {}
+        for move_plan in plan:
+            if not move_plan['not_picked_n_packages']:
+                continue
+            move = move_plan['move']
+            key = (move.product.id,
+                move.lot.id if move.lot else None,
+                move.package.id,
+                move.from_location.id)
+            shortage = shortages.setdefault(key, {
+                    'number_of_packages': 0,
+                    'quantity': 0.0,
+                    'moves': [],
+                    })
+            shortage['number_of_packages'] += (
+                move_plan['not_picked_n_packages'])
+            shortage['quantity'] += Uom.compute_qty(move.uom,
+                move_plan['not_picked_quantity'], move.product.default_uom)
+            shortage['moves'].append(move)
+        return shortages
+
+    @classmethod
+    def get_number_of_packages_availability(cls, moves, with_childs,
+            grouping):
+        """
+        Read the number of packages available to assign moves grouped by
+        grouping.
+        Return a dictionary that can be passed to plan_number_of_packages
+        as many times as needed, as it is never modified by the planner.
+        """
         pool = Pool()
-        Package = pool.get('product.pack')
         Product = pool.get('product.product')
-        Uom = pool.get('product.uom')
         Date = pool.get('ir.date')
         Location = pool.get('stock.location')
         Lot = pool.get('stock.lot')
-        Move = pool.get('stock.move')
-
-        Transaction().database.lock(Transaction().connection, cls._table)
 
         if with_childs:
             location2childs = {}
@@ -235,7 +433,7 @@ class Move(metaclass=PoolMeta):
         else:
             location2childs = {m.from_location.id: [m.from_location]
                 for m in moves}
-            location_ids = location2childs.keys()
+            location_ids = list(location2childs.keys())
 
         product_ids = list(set([m.product.id for m in moves]))
         with Transaction().set_context(
@@ -257,9 +455,58 @@ class Move(metaclass=PoolMeta):
             if grouping[-1] == 'lot' and key[-1]:
                 id2lot[key[-1]] = None
 
+        lot_keys = {}
         if grouping[-1] == 'lot':
             lots = Lot.browse(id2lot.keys())
             id2lot = {l.id: l for l in lots}
+            lot_keys = {l.id: cls._lot_to_pick_key(l) for l in lots}
+
+        return {
+            'grouping': grouping,
+            'with_childs': with_childs,
+            'products': set(product_ids),
+            'location2childs': location2childs,
+            'number_of_packages': pbl2,
+            'lots': id2lot,
+            'lot_keys': lot_keys,
+            }
+
+    @classmethod
+    def plan_number_of_packages(cls, moves, with_childs, grouping,
+            availability=None):
+        """
+        Compute how moves would be assigned by assign_try_number_of_packages
+        without locking nor writing anything.
+        Return a list of dictionaries, one per draft move, with keys:
+            - move: the move
+            - picks: list of values to write on the move or its copies
+            - picked_quantity: quantity of the picks in the UoM of the move
+            - not_picked_n_packages: number of packages that can not be picked
+            - not_picked_quantity: quantity of not_picked_n_packages in the
+              UoM of the move
+        availability must have been read for the same grouping, with_childs,
+        source locations and products as moves.
+        """
+        pool = Pool()
+        Package = pool.get('product.pack')
+        Uom = pool.get('product.uom')
+
+        if availability is None:
+            availability = cls.get_number_of_packages_availability(moves,
+                with_childs, grouping)
+        assert availability['grouping'] == grouping, "Unexpected grouping"
+        assert availability['with_childs'] == with_childs, \
+            "Unexpected with_childs"
+        location2childs = availability['location2childs']
+        assert all(m.from_location.id in location2childs
+            and m.product.id in availability['products']
+            for m in moves if m.state == 'draft'), \
+            "Moves not covered by availability"
+        id2lot = availability['lots']
+        lot_keys = availability['lot_keys']
+        # Picking consumes the availability, so work on a copy
+        pbl2 = {k: v.copy()
+            for k, v in availability['number_of_packages'].items()}
 
         def get_key(move, location):
             key = (location.id,)
@@ -270,9 +517,23 @@ class Move(metaclass=PoolMeta):
                 key += (value,)
             return key
 
-        success = True
-        to_write = []
-        to_assign = []
+        # Lot order of each (location, product), reused until a new lot
+        # appears in that location and product. The quantities are always
+        # read from pbl2
+        lots_order = {}
+
+        def get_sorted_lots(subkey):
+            if subkey not in lots_order:
+                lots_to_pick = sorted(((id2lot[lot_id], n_packages)
+                        for lot_id, n_packages in pbl2[subkey].items()
+                        if lot_id),
+                    key=lambda x: lot_keys[x[0].id])
+                lots_order[subkey] = [lot_id for lot_id, _
+                    in cls._sort_lots_to_pick(lots_to_pick)]
+            return [(lot_id, pbl2[subkey][lot_id])
+                for lot_id in lots_order[subkey]]
+
+        plan = []
         for move in moves:
             if move.state != 'draft':
                 continue
@@ -286,11 +547,7 @@ class Move(metaclass=PoolMeta):
                     if subkey in pbl2:
                         if grouping[-1] == 'lot':
                             location_n_packages[location] = (
-                                cls._sort_lots_to_pick([
-                                    (id2lot[key2], n_packages)
-                                    for key2, n_packages
-                                    in pbl2[subkey].items()
-                                    if key2]))
+                                get_sorted_lots(subkey))
                         else:
                             location_n_packages[location] = [
                                 (key2, n_packages)
@@ -314,13 +571,10 @@ class Move(metaclass=PoolMeta):
 
             not_picked_n_packages = 0
             if move.number_of_packages > picked_n_packages:
-                success = False
-                first = False
                 not_picked_n_packages = (move.number_of_packages
                     - picked_n_packages)
-            else:
-                first = True
 
+            picks = []
             picked_qty = 0.0
             for from_location, key, n_packages, _ in to_pick:
                 values = {
@@ -330,7 +584,7 @@ class Move(metaclass=PoolMeta):
                 if key:
                     values[grouping[-1]] = key
                     if grouping[-1] == 'lot':
-                        lot = Lot(key)
+                        lot = id2lot[key]
                         if not move.package or lot.package != move.package:
                             values['package'] = lot.package.id
                         values['quantity'] = Uom.compute_qty(
@@ -350,43 +604,46 @@ class Move(metaclass=PoolMeta):
                         n_packages * move.package.qty,
                         move.uom)
                 picked_qty += values.get('quantity', 0.0)
+                picks.append(values)
+
+                for subkey, n in (
+                        (get_key(move, from_location)[:-1], -n_packages),
+                        (get_key(move, to_location)[:-1], n_packages)):
+                    if key not in pbl2.setdefault(subkey, {}):
+                        pbl2[subkey][key] = 0
+                        lots_order.pop(subkey, None)
+                    pbl2[subkey][key] += n
+
+            plan.append({
+                    'move': move,
+                    'picks': picks,
+                    'picked_quantity': picked_qty,
+                    'not_picked_n_packages': not_picked_n_packages,
+                    'not_picked_quantity': (Uom.compute_qty(
+                            move.package.uom,
+                            not_picked_n_packages * move.package.qty,
+                            move.uom)
+                        if not_picked_n_packages else 0.0),
+                    })
+        return plan
 
-                if first:
-                    to_write.extend(([move], values))
-                    to_assign.append(move)
-                    first = False
-                else:
-                    new_move, = cls.copy([move], default=values)
-                    to_assign.append(new_move)
-
-                from_subkey = get_key(move, from_location)[:-1]
-                pbl2.setdefault(from_subkey, {}).setdefault(key, 0)
-                pbl2[from_subkey][key] -= n_packages
-
-                to_subkey = get_key(move, to_location)[:-1]
-                pbl2.setdefault(to_subkey, {}).setdefault(key, 0)
-                pbl2[to_subkey][key] += n_packages
-
-            if not_picked_n_packages:
-                to_write.extend(([move], {
-                            'number_of_packages': not_picked_n_packages,
-                            'quantity': (not_picked_n_packages*
-                                move.package.qty)
-                            }))
-            if not_picked_n_packages <= 0 :
-                success=True
-
-        if to_write:
-            Move.write(*to_write)
-        if to_assign:
-            Move.assign(to_assign)
-        return success
+    @classmethod
+    def _lot_to_pick_key(cls, lot):
+        """
+        Return the key used to sort lot to pick, lower first.
+        It is computed once per lot and assignment, so it must only depend
+        on the lot attributes (ie: expiration date).
+        """
+        return 0
 
     @classmethod
     def _sort_lots_to_pick(cls, lots_to_pick):
         """
-        Receive a list of (lot, quantity) and return an ordered ist of
-        (lot_id, quantity)
+        Receive a list of (lot, quantity), already sorted by _lot_to_pick_key,
+        and return an ordered ist of (lot_id, quantity)
+        Only the order of the result is used: it is computed once per
+        location and product and kept while picking changes the quantities,
+        so it must not depend on them.
         """
         return [(x[0].id, x[1]) for x in lots_to_pick]
 
@@ -543,6 +800,18 @@ class ShipmentOut(metaclass=PoolMeta):
         with Transaction().set_context(assign_number_of_packages=True):
             return super(ShipmentOut, cls).assign_try(shipments)
 
+    @classmethod
+    def assign_try_with_shortages(cls, shipments):
+        """
+        Try to assign shipments with assign_try and return a tuple with the
+        success and the shortages of their inventory moves.
+        """
+        shortages = {}
+        with Transaction().set_context(
+                number_of_packages_shortages=shortages):
+            success = cls.assign_try(shipments)
+        return success, shortages
+
 
 class Location(metaclass=PoolMeta):
     __name__ = 'stock.location'
@@ -556,13 +825,87 @@ class Location(metaclass=PoolMeta):
         'get_number_of_packages')
 
     @classmethod
-    def get_number_of_packages(cls, locations, name):
-        if name.endswith('normalized_number_of_packages'):
-            new_name = name.replace('normalized_number_of_packages',
-                'number_of_packages')
-            with Transaction().set_context(number_of_packages=True):
-                return super(Location, cls).get_number_of_packages(
-                    locations, new_name)
-        else:
-            return super(Location, cls).get_number_of_packages(
+    def get_number_of_packages(cls, locations, names):
+        # Overrides with the single name signature call super with a string
+        if isinstance(names, str):
+            return cls._get_number_of_packages(locations, [names])[names]
+        return cls._get_number_of_packages(locations, names)
+
+    @classmethod
+    def _get_number_of_packages(cls, locations, names):
+        """
+        Return the number of packages columns from the base getter and
+        compute all the requested normalized columns together, with one
+        products_by_location grouped by lot by date (current and forecast).
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Lot = pool.get('stock.lot')
+        Date = pool.get('ir.date')
+        trans_context = Transaction().context
+
+        result = {}
+        normalized_names = []
+        for name in names:
+            if name.endswith('normalized_number_of_packages'):
+                normalized_names.append(name)
+            else:
+                result[name] = super(Location, cls).get_number_of_packages(
                     locations, name)
+        if not normalized_names:
+            return result
+
+        product_id = trans_context.get('product')
+        if not isinstance(product_id, int):
+            for name in normalized_names:
+                new_name = name.replace('normalized_number_of_packages',
+                    'number_of_packages')
+                with Transaction().set_context(number_of_packages=True,
+                        normalized_number_of_packages=True):
+                    result[name] = super(Location,
+                        cls).get_number_of_packages(locations, new_name)
+            return result
+
+        today = Date.today()
+        forecast_names = {n: n.startswith('forecast_')
+            for n in normalized_names}
+        for name in normalized_names:
+            result[name] = dict((l.id, 0) for l in locations)
+        for forecast in set(forecast_names.values()):
+            context = {
+                'number_of_packages': True,
+                }
+            if forecast:
+                context['forecast'] = True
+                if not trans_context.get('stock_date_end'):
+                    context['stock_date_end'] = datetime.date.max
+            elif ((trans_context.get('stock_date_end') or datetime.date.max)
+                    > today):
+                context['stock_date_end'] = today
+
+            pbl = {}
+            for sub_locations in grouped_slice(locations):
+                with Transaction().set_context(context):
+                    pbl.update(Product.products_by_location(
+                            [l.id for l in sub_locations],
+                            grouping=('product', 'lot'),
+                            grouping_filter=([product_id],),
+                            with_childs=trans_context.get('with_childs',
+                                True)))
+
+            id2lot = {l.id: l for l in Lot.browse(
+                    list({k[-1] for k in pbl if k[-1]}))}
+            for name, name_forecast in forecast_names.items():
+                if name_forecast != forecast:
+                    continue
+                values = result[name]
+                for (location_id, _, lot_id), n_packages in pbl.items():
+                    if location_id not in values:
+                        continue
+                    n_packages = int(n_packages)
+                    if lot_id:
+                        lot = id2lot[lot_id]
+                        n_packages = lot.compute_normalized_number_of_packages(
+                            n_packages)
+                    values[location_id] += n_packages
+        return result
@@ -1,14 +1,732 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import datetime
+import io
 import unittest
+from contextlib import contextmanager
+from decimal import Decimal
+from unittest.mock import patch
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.account.tests import create_chart
+
+
+class QueryCounter(object):
+    'Connection wrapper counting the executed queries'
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.count = 0
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        counter = self
+        cursor = self._connection.cursor(*args, **kwargs)
+
+        class Cursor(object):
+            def __getattr__(self, name):
+                return getattr(cursor, name)
+
+            def execute(self, *args, **kwargs):
+                counter.count += 1
+                return cursor.execute(*args, **kwargs)
+        return Cursor()
+
+
+@contextmanager
+def count_queries():
+    transaction = Transaction()
+    connection = transaction.connection
+    counter = QueryCounter(connection)
+    transaction.connection = counter
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+def create_product(name, package_qty=5, uom=None):
+    "Create a goods product with a package of package_qty"
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    Package = pool.get('product.pack')
+
+    if uom is None:
+        uom, = Uom.search([('name', '=', 'Unit')])
+    template, = Template.create([{
+                'name': name,
+                'type': 'goods',
+                'list_price': Decimal(1),
+                'default_uom': uom.id,
+                }])
+    product, = Product.create([{
+                'template': template.id,
+                }])
+    package, = Package.create([{
+                'name': 'Box',
+                'product': template.id,
+                'qty': package_qty,
+                }])
+    return product, package
+
+
+def create_move(product, package, from_location, to_location,
+        number_of_packages, lot=None):
+    "Create a draft move of number_of_packages of package"
+    pool = Pool()
+    Company = pool.get('company.company')
+    Move = pool.get('stock.move')
+
+    company = Company(Transaction().context['company'])
+    move, = Move.create([{
+                'product': product.id,
+                'uom': product.default_uom.id,
+                'quantity': number_of_packages * package.qty,
+                'package': package.id,
+                'number_of_packages': number_of_packages,
+                'lot': lot.id if lot else None,
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                'company': company.id,
+                'unit_price': Decimal('1'),
+                'currency': company.currency.id,
+                }])
+    return move
 
 
 class SaleNumberOfPackagesTestCase(ModuleTestCase):
     'Test Sale Number Of Packages module'
     module = 'sale_number_of_packages'
 
+    @with_transaction()
+    def test_process_invoice_lines_number_of_packages(self):
+        'Test processing sales fills invoice line packages from moves'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Account = pool.get('account.account')
+        Category = pool.get('product.category')
+        Template = pool.get('product.template')
+        Move = pool.get('stock.move')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search([('kind', '=', 'revenue')])
+            expense, = Account.search([('kind', '=', 'expense')])
+            category, = Category.create([{
+                        'name': 'Accounting',
+                        'accounting': True,
+                        'account_revenue': revenue.id,
+                        'account_expense': expense.id,
+                        }])
+            party, = Party.create([{
+                        'name': 'Customer',
+                        'addresses': [('create', [{}])],
+                        }])
+
+            def shipped_sale(size):
+                lines = []
+                for i in range(size):
+                    product, package = create_product('Product %s' % i)
+                    Template.write([product.template], {
+                            'salable': True,
+                            'sale_uom': product.default_uom.id,
+                            'account_category': category.id,
+                            })
+                    lines.append({
+                            'product': product.id,
+                            'description': product.rec_name,
+                            'quantity': 10,
+                            'unit': product.default_uom.id,
+                            'unit_price': Decimal(1),
+                            'package': package.id,
+                            'number_of_packages': 2,
+                            })
+                sale, = Sale.create([{
+                            'party': party.id,
+                            'invoice_address': party.addresses[0].id,
+                            'shipment_address': party.addresses[0].id,
+                            'invoice_method': 'shipment',
+                            'lines': [('create', lines)],
+                            }])
+                Sale.quote([sale])
+                Sale.confirm([sale])
+                Sale.process([sale])
+                sale = Sale(sale.id)
+                moves = [m for l in sale.lines for m in l.moves]
+                # Ship one package less than sold on the first line
+                Move.write(moves[:1], {
+                        'quantity': 5,
+                        'number_of_packages': 1,
+                        })
+                Move.do(moves)
+                return Sale(sale.id)
+
+            sales = [shipped_sale(1), shipped_sale(5)]
+            for sale in sales:
+                expected = {}
+                for line in sale.lines:
+                    expected[line] = [(l.package, l.number_of_packages)
+                        for l in line.get_invoice_line()]
+                self.assertEqual(expected[sale.lines[0]][0][1], 1)
+
+                Sale.process([sale])
+                invoice, = Sale(sale.id).invoices
+                self.assertEqual(len(invoice.lines), len(sale.lines))
+                for invoice_line in invoice.lines:
+                    self.assertEqual(
+                        [(invoice_line.package,
+                                invoice_line.number_of_packages)],
+                        expected[invoice_line.origin])
+
+            # Not contiguous ids so reduce_ids can not build a range
+            moves = Move.search([
+                    ('origin', 'like', 'sale.line,%'),
+                    ], order=[('id', 'ASC')])[::2]
+            counts = []
+            for size in (1, len(moves)):
+                with count_queries() as counter:
+                    values = SaleLine._get_moves_number_of_packages(
+                        [m.id for m in moves[:size]])
+                counts.append(counter.count)
+                self.assertEqual(values, {
+                        m.id: (m.number_of_packages, m.package.id)
+                        for m in moves[:size]})
+            self.assertEqual(counts, [1, 1])
+
+    @with_transaction()
+    def test_quantity_to_number_of_packages(self):
+        'Test quantity_to_number_of_packages'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        Package = pool.get('product.pack')
+        SaleLine = pool.get('sale.line')
+
+        kilogram = Uom(ModelData.get_id('product', 'uom_kilogram'))
+        gram = Uom(ModelData.get_id('product', 'uom_gram'))
+
+        line = SaleLine(package=Package(qty=0.1, uom=kilogram))
+        # int(round(0.35 / 0.1)) is 3
+        self.assertEqual(line.quantity_to_number_of_packages(0.35, kilogram),
+            4)
+        self.assertEqual(line.quantity_to_number_of_packages(350, gram), 4)
+        self.assertEqual(line.quantity_to_number_of_packages(0.45, kilogram),
+            4)
+
+        line = SaleLine(package=Package(qty=2, uom=kilogram))
+        self.assertEqual(line.quantity_to_number_of_packages(5, kilogram), 2)
+        self.assertEqual(line.quantity_to_number_of_packages(7, kilogram), 4)
+        self.assertEqual(line.quantity_to_number_of_packages(5000, gram), 2)
+
+    @with_transaction()
+    def test_get_move_uom(self):
+        'Test get_move number of packages with another UoM than the package'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+        Template = pool.get('product.template')
+        Move = pool.get('stock.move')
+        Sale = pool.get('sale.sale')
+
+        kilogram = Uom(ModelData.get_id('product', 'uom_kilogram'))
+        gram = Uom(ModelData.get_id('product', 'uom_gram'))
+        product, package = create_product('Test get_move', package_qty=2,
+            uom=kilogram)
+        Template.write([product.template], {
+                'salable': True,
+                'sale_uom': kilogram.id,
+                })
+        output, = Location.search([('code', '=', 'OUT')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        party, = Party.create([{
+                    'name': 'Customer',
+                    'addresses': [('create', [{}])],
+                    }])
+        company = create_company()
+        with set_company(company):
+            sale, = Sale.create([{
+                        'party': party.id,
+                        'invoice_address': party.addresses[0].id,
+                        'shipment_address': party.addresses[0].id,
+                        'lines': [('create', [{
+                                        'product': product.id,
+                                        'description': product.rec_name,
+                                        'quantity': 6000,
+                                        'unit': gram.id,
+                                        'unit_price': Decimal(1),
+                                        'package': package.id,
+                                        'number_of_packages': 3,
+                                        }])],
+                        }])
+            line, = sale.lines
+
+            move = line.get_move('out')
+            self.assertEqual(move.uom, gram)
+            self.assertEqual(move.quantity, 6000)
+            self.assertEqual(move.package, package)
+            self.assertEqual(move.number_of_packages, 3)
+
+            # One package (2 kg) already shipped
+            shipped_move = create_move(product, package, output, customer, 1)
+            Move.write([shipped_move], {'origin': str(line)})
+            line = Sale(sale.id).lines[0]
+
+            move = line.get_move('out')
+            self.assertEqual(move.uom, gram)
+            self.assertEqual(move.quantity, 4000)
+            self.assertEqual(move.number_of_packages, 2)
+
+    @with_transaction()
+    def test_plan_number_of_packages(self):
+        'Test plan_number_of_packages matches assign and writes nothing'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        product, package = create_product('Test plan_number_of_packages')
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        company = create_company()
+        with set_company(company):
+            Move.do([create_move(product, package, supplier, storage, 4)])
+            move = create_move(product, package, storage, customer, 6)
+            grouping = ('product', 'package')
+
+            availability = Move.get_number_of_packages_availability([move],
+                True, grouping)
+            for _ in range(2):
+                plan = Move.plan_number_of_packages([move], True, grouping,
+                    availability=availability)
+                move_plan, = plan
+                self.assertEqual(move_plan['move'], move)
+                self.assertEqual(move_plan['picks'], [{
+                            'from_location': storage.id,
+                            'number_of_packages': 4,
+                            'package': package.id,
+                            'quantity': 20,
+                            }])
+                self.assertEqual(move_plan['picked_quantity'], 20)
+                self.assertEqual(move_plan['not_picked_n_packages'], 2)
+                self.assertEqual(move_plan['not_picked_quantity'], 10)
+                self.assertEqual(Move.get_number_of_packages_shortages(plan),
+                    {(product.id, None, package.id, storage.id): {
+                            'number_of_packages': 2,
+                            'quantity': 10,
+                            'moves': [move],
+                            }})
+
+            # Nothing written by the planner
+            self.assertEqual(Move.search([
+                        ('from_location', '=', storage.id),
+                        ], count=True), 1)
+            move = Move(move.id)
+            self.assertEqual(move.state, 'draft')
+            self.assertEqual(move.number_of_packages, 6)
+            self.assertEqual(move.quantity, 30)
+
+            self.assertFalse(Move.assign_try_number_of_packages([move], True,
+                    grouping))
+            assigned, = Move.search([
+                    ('from_location', '=', storage.id),
+                    ('state', '=', 'assigned'),
+                    ])
+            self.assertEqual(assigned.number_of_packages, 4)
+            self.assertEqual(assigned.quantity, 20)
+            move = Move(move.id)
+            self.assertEqual(move.state, 'draft')
+            self.assertEqual(move.number_of_packages, 2)
+            self.assertEqual(move.quantity, 10)
+
+    @with_transaction()
+    def test_lot_to_pick_key(self):
+        'Test lots are picked in _lot_to_pick_key order'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+
+        product, package = create_product('Test _lot_to_pick_key')
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        lot1, lot2 = Lot.create([{
+                    'number': '1',
+                    'product': product.id,
+                    'package': package.id,
+                    }, {
+                    'number': '2',
+                    'product': product.id,
+                    'package': package.id,
+                    }])
+        company = create_company()
+        with set_company(company):
+            Move.do([
+                    create_move(product, package, supplier, storage, 1,
+                        lot=lot1),
+                    create_move(product, package, supplier, storage, 3,
+                        lot=lot2),
+                    ])
+            move = create_move(product, package, storage, customer, 2)
+            grouping = ('product', 'lot')
+
+            for keys, picks in (
+                    ({lot1.id: 1, lot2.id: 0}, [(lot2.id, 2)]),
+                    ({lot1.id: 0, lot2.id: 1}, [(lot1.id, 1), (lot2.id, 1)]),
+                    ):
+                with patch.object(Move, '_lot_to_pick_key',
+                        side_effect=lambda lot: keys[lot.id]):
+                    move_plan, = Move.plan_number_of_packages([move], True,
+                        grouping)
+                self.assertEqual(
+                    [(p['lot'], p['number_of_packages'])
+                        for p in move_plan['picks']],
+                    picks)
+
+    @with_transaction()
+    def test_plan_number_of_packages_lots_order(self):
+        'Test the lots order is reused until a new lot is available'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+
+        product, package = create_product('Test lots order')
+        supplier, = Location.search([('code', '=', 'SUP')])
+        warehouse, = Location.search([('code', '=', 'WH')])
+        storage, = Location.search([('code', '=', 'STO')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        other, = Location.create([{
+                    'name': 'Other',
+                    'type': 'storage',
+                    'parent': warehouse.id,
+                    }])
+        lot1, lot2 = Lot.create([{
+                    'number': '1',
+                    'product': product.id,
+                    'package': package.id,
+                    }, {
+                    'number': '2',
+                    'product': product.id,
+                    'package': package.id,
+                    }])
+        company = create_company()
+        with set_company(company):
+            Move.do([
+                    create_move(product, package, supplier, storage, 4,
+                        lot=lot1),
+                    create_move(product, package, supplier, other, 1,
+                        lot=lot2),
+                    ])
+            moves = [
+                create_move(product, package, other, customer, 1),
+                create_move(product, package, storage, other, 2),
+                create_move(product, package, other, customer, 2),
+                create_move(product, package, storage, customer, 2),
+                ]
+
+            with patch.object(Move, '_sort_lots_to_pick',
+                    side_effect=Move._sort_lots_to_pick) as sort_lots:
+                plan = Move.plan_number_of_packages(moves, True,
+                    ('product', 'lot'))
+            # Once for other and storage, and again for other when the
+            # second move brings lot1 to it
+            self.assertEqual(sort_lots.call_count, 3)
+            self.assertEqual(
+                [[(p['from_location'], p['lot'], p['number_of_packages'])
+                        for p in move_plan['picks']]
+                    for move_plan in plan],
+                [
+                    [(other.id, lot2.id, 1)],
+                    [(storage.id, lot1.id, 2)],
+                    [(other.id, lot1.id, 2)],
+                    [(storage.id, lot1.id, 2)],
+                    ])
+            self.assertEqual(
+                [move_plan['not_picked_n_packages'] for move_plan in plan],
+                [0, 0, 0, 0])
+
+    @with_transaction()
+    def test_location_number_of_packages(self):
+        'Test location number of packages columns'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+
+        product, package = create_product('Test location')
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        child, = Location.create([{
+                    'name': 'Child',
+                    'type': 'storage',
+                    'parent': storage.id,
+                    }])
+        multiplier_lot, divider_lot = Lot.create([{
+                    'number': 'Multiplier',
+                    'product': product.id,
+                    'package': package.id,
+                    'number_of_packages_multiplier': 2,
+                    }, {
+                    'number': 'Divider',
+                    'product': product.id,
+                    'package': package.id,
+                    'number_of_packages_divider': 3,
+                    }])
+        company = create_company()
+        with set_company(company):
+            Move.do([
+                    create_move(product, package, supplier, child, 4,
+                        lot=multiplier_lot),
+                    create_move(product, package, supplier, storage, 1,
+                        lot=divider_lot),
+                    create_move(product, package, supplier, storage, 1),
+                    ])
+            forecast_move = create_move(product, package, supplier, child, 2,
+                lot=multiplier_lot)
+            forecast_move.planned_date = (
+                Date.today() + datetime.timedelta(days=1))
+            forecast_move.save()
+
+            names = [
+                'number_of_packages',
+                'forecast_number_of_packages',
+                'normalized_number_of_packages',
+                'forecast_normalized_number_of_packages',
+                ]
+            locations = [storage, child]
+            for context, expected in (
+                    ({}, {
+                            'number_of_packages': {
+                                storage.id: 6, child.id: 4},
+                            'forecast_number_of_packages': {
+                                storage.id: 8, child.id: 6},
+                            'normalized_number_of_packages': {
+                                storage.id: 6, child.id: 2},
+                            'forecast_normalized_number_of_packages': {
+                                storage.id: 7, child.id: 3},
+                            }),
+                    ({'with_childs': False}, {
+                            'number_of_packages': {
+                                storage.id: 2, child.id: 4},
+                            'forecast_number_of_packages': {
+                                storage.id: 2, child.id: 6},
+                            'normalized_number_of_packages': {
+                                storage.id: 4, child.id: 2},
+                            'forecast_normalized_number_of_packages': {
+                                storage.id: 4, child.id: 3},
+                            }),
+                    ({'stock_date_end': datetime.date.max}, {
+                            'number_of_packages': {
+                                storage.id: 6, child.id: 4},
+                            'forecast_number_of_packages': {
+                                storage.id: 8, child.id: 6},
+                            'normalized_number_of_packages': {
+                                storage.id: 6, child.id: 2},
+                            'forecast_normalized_number_of_packages': {
+                                storage.id: 7, child.id: 3},
+                            }),
+                    ):
+                context['product'] = product.id
+                with Transaction().set_context(context):
+                    self.assertEqual(
+                        Location.get_number_of_packages(locations, names),
+                        expected)
+                    for name in names:
+                        self.assertEqual(
+                            Location.get_number_of_packages(locations, name),
+                            expected[name])
+                    for location in Location.browse(locations):
+                        for name in names:
+                            self.assertEqual(getattr(location, name),
+                                expected[name][location.id])
+
+    @with_transaction()
+    def test_package_positions(self):
+        'Test package_positions and export_package_positions'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+
+        product, package = create_product('Test positions')
+        other_product, other_package = create_product('Other positions')
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        child, = Location.create([{
+                    'name': 'Child',
+                    'type': 'storage',
+                    'parent': storage.id,
+                    }])
+        lot, = Lot.create([{
+                    'number': 'Multiplier',
+                    'product': product.id,
+                    'package': package.id,
+                    'number_of_packages_multiplier': 2,
+                    }])
+        company = create_company()
+        with set_company(company):
+            Move.do([
+                    create_move(product, package, supplier, child, 4,
+                        lot=lot),
+                    create_move(product, package, supplier, storage, 1),
+                    create_move(other_product, other_package, supplier,
+                        storage, 3),
+                    ])
+            expected = [
+                (child.id, product.id, lot.id, package.id, 4, 2),
+                (storage.id, product.id, None, package.id, 1, 1),
+                (storage.id, other_product.id, None, other_package.id, 3, 3),
+                ]
+            product_ids = [product.id, other_product.id]
+
+            for size in (None, 1):
+                self.assertEqual(sorted(Product.package_positions(
+                            [storage.id], product_ids=product_ids,
+                            size=size), key=str),
+                    sorted(expected, key=str))
+            # Two generators open at the same time
+            positions = Product.package_positions([storage.id],
+                product_ids=product_ids, size=1)
+            first = next(positions)
+            self.assertEqual(
+                sorted(Product.package_positions([storage.id],
+                        product_ids=product_ids), key=str),
+                sorted(expected, key=str))
+            self.assertEqual(sorted([first] + list(positions), key=str),
+                sorted(expected, key=str))
+
+            file = io.StringIO()
+            Product.export_package_positions(file, [storage.id],
+                product_ids=product_ids)
+            rows = list(csv.reader(io.StringIO(file.getvalue())))
+            self.assertEqual(rows[0], ['location', 'product', 'lot',
+                    'package', 'number_of_packages',
+                    'normalized_number_of_packages'])
+            self.assertEqual(sorted(rows[1:]), sorted(
+                    [['' if v is None else str(v) for v in p]
+                        for p in expected]))
+
+    @with_transaction()
+    def test_assign_try_number_of_packages_success(self):
+        'Test assign_try_number_of_packages fails if any move is short'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        short_product, short_package = create_product('Short')
+        product, package = create_product('Available')
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        company = create_company()
+        with set_company(company):
+            Move.do([create_move(product, package, supplier, storage, 4)])
+            short_move = create_move(short_product, short_package, storage,
+                customer, 2)
+            move = create_move(product, package, storage, customer, 3)
+
+            self.assertFalse(Move.assign_try_number_of_packages(
+                    [short_move, move], True, ('product', 'package')))
+            short_move = Move(short_move.id)
+            move = Move(move.id)
+            self.assertEqual(short_move.state, 'draft')
+            self.assertEqual(move.state, 'assigned')
+
+    @with_transaction()
+    def test_assign_try_with_shortages(self):
+        'Test Move.assign_try_with_shortages'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        short_product, short_package = create_product('Short')
+        product, package = create_product('Available')
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        company = create_company()
+        with set_company(company):
+            Move.do([create_move(product, package, supplier, storage, 4)])
+            short_move = create_move(short_product, short_package, storage,
+                customer, 2)
+            move = create_move(product, package, storage, customer, 3)
+
+            success, shortages = Move.assign_try_with_shortages(
+                [short_move, move])
+            self.assertFalse(success)
+            self.assertEqual(shortages, {
+                    (short_product.id, None, short_package.id, storage.id): {
+                        'number_of_packages': 2,
+                        'quantity': 10,
+                        'moves': [short_move],
+                        },
+                    })
+            self.assertEqual(Move(move.id).state, 'assigned')
+
+    @with_transaction()
+    def test_shipment_out_assign_try_with_shortages(self):
+        'Test ShipmentOut.assign_try_with_shortages'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        product, package = create_product('Test shipment')
+        supplier, = Location.search([('code', '=', 'SUP')])
+        warehouse, = Location.search([('code', '=', 'WH')])
+        storage, = Location.search([('code', '=', 'STO')])
+        output, = Location.search([('code', '=', 'OUT')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        party, = Party.create([{
+                    'name': 'Customer',
+                    'addresses': [('create', [{}])],
+                    }])
+        company = create_company()
+        with set_company(company):
+            Move.do([create_move(product, package, supplier, storage, 4)])
+            shipment, = ShipmentOut.create([{
+                        'customer': party.id,
+                        'delivery_address': party.addresses[0].id,
+                        'warehouse': warehouse.id,
+                        'company': company.id,
+                        }])
+            moves = [
+                create_move(product, package, output, customer, 6),
+                create_move(product, package, storage, output, 6),
+                ]
+            Move.write(moves, {'shipment': str(shipment)})
+            shipment = ShipmentOut(shipment.id)
+            inventory_move, = shipment.inventory_moves
+
+            success, shortages = ShipmentOut.assign_try_with_shortages(
+                [shipment])
+            self.assertFalse(success)
+            self.assertEqual(shortages, {
+                    (product.id, None, package.id, storage.id): {
+                        'number_of_packages': 2,
+                        'quantity': 10,
+                        'moves': [inventory_move],
+                        },
+                    })
+            self.assertNotEqual(ShipmentOut(shipment.id).state, 'assigned')
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()